@@ -5,19 +5,31 @@ send data to InfluxDB, and support Home Assistant auto discovery.
 """
 
 import os
-import glob
 import time
 import json
+import asyncio
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import signal
+import socket
 import sys
 
 # Import MQTT client
 import paho.mqtt.client as mqtt
 
 # Import InfluxDB client for InfluxDB 2.x
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions
+
+# Prefer orjson for JSON encoding; fall back to the standard library.
+# Either way json_dumps() returns bytes, which paho publishes as-is.
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 # Try importing RPi.GPIO; if not available (for testing on non-RPi systems), simulate
 try:
@@ -43,8 +55,9 @@ except ImportError:
 # These values are set in the installation script and loaded from ~/.beerpi_install_config.
 MQTT_BROKER_HOST       = os.environ.get("MQTT_BROKER_HOST", "localhost")
 MQTT_BROKER_PORT       = int(os.environ.get("MQTT_BROKER_PORT", "1883"))
-MQTT_TOPIC_TEMPERATURE = os.environ.get("MQTT_TOPIC_TEMPERATURE", "beerpi/temperature")
-MQTT_TOPIC_RELAY       = os.environ.get("MQTT_TOPIC_RELAY", "beerpi/relay")
+MQTT_CLIENT_ID         = os.environ.get("MQTT_CLIENT_ID", "beerpi")
+# Temperature and relay state are published together as one JSON payload.
+MQTT_TOPIC_STATE       = os.environ.get("MQTT_TOPIC_STATE", "beerpi/state")
 
 INFLUX_URL    = os.environ.get("INFLUX_URL", "http://localhost:8086")
 INFLUX_ORG    = os.environ.get("INFLUX_ORG", "beerpi")
@@ -57,80 +70,233 @@ POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "5"))
 # GPIO pin for relay (default 27)
 GPIO_RELAY_PIN = int(os.environ.get("GPIO_RELAY_PIN", "27"))
 
+# DS18B20 sysfs file, resolved once in main(); assume only one sensor is connected.
+# DS18B20 devices show up as 28-<serial> under the 1-Wire devices directory.
+W1_DEVICES_DIR = "/sys/bus/w1/devices"
+DS18B20_PREFIX = "28-"
+_SENSOR_FILE = None
+# Descriptor for _SENSOR_FILE, kept open and re-read from offset 0 each poll.
+_SENSOR_FD = None
+
 # Log file configuration
 LOG_FILE = os.environ.get("LOG_FILE", "/var/log/beerpi.log")
 LOG_MAX_BYTES = 10 * 1024 * 1024  # 10 MB
 LOG_BACKUP_COUNT = 7
+# Raise to WARNING in production to skip the per-cycle INFO lines entirely.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
-# Set up logging with a rotating file handler.
+# The formatter only uses asctime, levelname and message, so skip collecting
+# thread/process info and the caller's source location for every record.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging._srcfile = None
+
+# Set up logging with a rotating file handler. Records are handed to a
+# background QueueListener so file writes never block the poll loop.
 logger = logging.getLogger("BeerPi")
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
 handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
-logger.addHandler(handler)
+log_queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, handler)
+log_listener.start()
+
+# InfluxDB batching: points are queued and POSTed together once BATCH_SIZE
+# points are pending or every FLUSH_INTERVAL milliseconds, whichever comes first.
+INFLUX_BATCH_SIZE     = int(os.environ.get("INFLUX_BATCH_SIZE", "100"))
+INFLUX_FLUSH_INTERVAL = int(os.environ.get("INFLUX_FLUSH_INTERVAL", "10000"))
 
 # Set up InfluxDB client
 influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-write_api = influx_client.write_api(write_options=WritePrecision.S)
+write_api = influx_client.write_api(write_options=WriteOptions(
+    batch_size=INFLUX_BATCH_SIZE,
+    flush_interval=INFLUX_FLUSH_INTERVAL,
+    jitter_interval=2_000,
+    retry_interval=5_000,
+    # Bound how long cleanup() waits on a final flush if InfluxDB is down,
+    # staying well inside systemd's default 90 s stop timeout.
+    max_close_wait=10_000,
+))
+
+# MQTT keepalive in seconds; loop_misc() sends pings based on this.
+MQTT_KEEPALIVE = 60
+# Reconnect backoff bounds in seconds, used by mqtt_misc_loop().
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 30
+# Timeout for the non-blocking reachability probe before each reconnect, in seconds.
+MQTT_CONNECT_TIMEOUT = 5
+# Current reconnect backoff; grows on every attempt that does not end in an
+# accepted session and is only reset by on_mqtt_connect() on CONNACK_ACCEPTED.
+_mqtt_reconnect_delay = MQTT_RECONNECT_MIN_DELAY
+
+# Set up MQTT client with a persistent session, so QoS 1 messages published
+# while the broker is unreachable are queued and sent after reconnecting.
+# Its network IO runs on the asyncio event loop (see attach_mqtt_to_loop()),
+# and mqtt_misc_loop() makes (and remakes) the connection in the background.
+mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
+mqtt_client.max_inflight_messages_set(20)
+mqtt_client.max_queued_messages_set(10000)
 
-# Set up MQTT client
-mqtt_client = mqtt.Client()
-mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+# Home Assistant discovery payloads never change at runtime, so serialize them once.
+TEMP_CONFIG_TOPIC = "homeassistant/sensor/beerpi_temperature/config"
+TEMP_CONFIG_PAYLOAD = json_dumps({
+    "name": "BeerPi Temperature",
+    "state_topic": MQTT_TOPIC_STATE,
+    "unit_of_measurement": "°C",
+    "device_class": "temperature",
+    "unique_id": "beerpi_temperature",
+    "value_template": "{{ value_json.temperature }}"
+})
+RELAY_CONFIG_TOPIC = "homeassistant/binary_sensor/beerpi_relay/config"
+RELAY_CONFIG_PAYLOAD = json_dumps({
+    "name": "BeerPi Relay",
+    "state_topic": MQTT_TOPIC_STATE,
+    "payload_on": "ON",
+    "payload_off": "OFF",
+    "device_class": "power",
+    "unique_id": "beerpi_relay",
+    "value_template": "{{ value_json.relay }}"
+})
+
+# Temperature sensor, then relay state (as a binary sensor).
+DISCOVERY_MESSAGES = [
+    (TEMP_CONFIG_TOPIC, TEMP_CONFIG_PAYLOAD),
+    (RELAY_CONFIG_TOPIC, RELAY_CONFIG_PAYLOAD),
+]
 
 def publish_homeassistant_discovery():
-    """Publish Home Assistant MQTT auto discovery messages for temperature and relay."""
-    # Temperature sensor discovery message
-    temp_config_topic = "homeassistant/sensor/beerpi_temperature/config"
-    temp_config_payload = {
-        "name": "BeerPi Temperature",
-        "state_topic": MQTT_TOPIC_TEMPERATURE,
-        "unit_of_measurement": "°C",
-        "device_class": "temperature",
-        "unique_id": "beerpi_temperature",
-        "value_template": "{{ value_json.temperature }}"
-    }
-    mqtt_client.publish(temp_config_topic, json.dumps(temp_config_payload))
-    logger.info("Published Home Assistant auto discovery for temperature sensor.")
-
-    # Relay state discovery message (as a binary sensor)
-    relay_config_topic = "homeassistant/binary_sensor/beerpi_relay/config"
-    relay_config_payload = {
-        "name": "BeerPi Relay",
-        "state_topic": MQTT_TOPIC_RELAY,
-        "payload_on": "ON",
-        "payload_off": "OFF",
-        "device_class": "power",
-        "unique_id": "beerpi_relay",
-        "value_template": "{{ value_json.relay }}"
-    }
-    mqtt_client.publish(relay_config_topic, json.dumps(relay_config_payload))
-    logger.info("Published Home Assistant auto discovery for relay state.")
+    """
+    Publish Home Assistant MQTT auto discovery messages for temperature and relay.
+    All configs are queued back to back on the client's single connection and
+    go out in one flight. They are retained so Home Assistant picks them up
+    after its own restarts, and use QoS 1 so they are queued until the broker
+    connection is up.
+    """
+    for topic, payload in DISCOVERY_MESSAGES:
+        mqtt_client.publish(topic, payload, qos=1, retain=True)
+    logger.info("Published Home Assistant auto discovery for %d entities.", len(DISCOVERY_MESSAGES))
+
+def on_mqtt_connect(client, userdata, flags, rc):
+    """Log the broker's CONNACK result and reset the reconnect backoff on success."""
+    global _mqtt_reconnect_delay
+    if rc == mqtt.CONNACK_ACCEPTED:
+        _mqtt_reconnect_delay = MQTT_RECONNECT_MIN_DELAY
+        logger.info("Connected to MQTT broker at %s:%s", MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+    else:
+        logger.warning("MQTT broker refused connection: %s", mqtt.connack_string(rc))
+
+def attach_mqtt_to_loop(loop):
+    """
+    Drive the paho client from the asyncio event loop instead of a
+    loop_start() thread: the socket is watched with add_reader/add_writer
+    and paho calls back whenever it has packets queued for writing.
+
+    Every client call (publish, loop_misc, reconnect) runs on the loop
+    thread, so the callbacks update the selector directly and in the order
+    paho issues them.
+    """
+    def on_socket_open(client, userdata, sock):
+        loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(client, userdata, sock):
+        loop.remove_reader(sock)
+        loop.remove_writer(sock)
+
+    def on_socket_register_write(client, userdata, sock):
+        loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(client, userdata, sock):
+        loop.remove_writer(sock)
+
+    mqtt_client.on_socket_open = on_socket_open
+    mqtt_client.on_socket_close = on_socket_close
+    mqtt_client.on_socket_register_write = on_socket_register_write
+    mqtt_client.on_socket_unregister_write = on_socket_unregister_write
+
+async def resolve_mqtt_broker():
+    """Resolve MQTT_BROKER_HOST without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    addrinfo = await loop.getaddrinfo(MQTT_BROKER_HOST, MQTT_BROKER_PORT, type=socket.SOCK_STREAM)
+    return addrinfo[0][4][0]
+
+async def connect_mqtt():
+    """
+    (Re)connect the MQTT client without stalling the event loop. The DNS
+    lookup and a TCP probe run asynchronously (the probe connection is closed
+    again). paho's reconnect() still has to run on the loop thread so it
+    never races send_data(). But it only runs once the broker has just
+    accepted a connection, so its blocking connect returns at once instead of
+    waiting out a timeout during an outage.
+    """
+    address = await resolve_mqtt_broker()
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(address, MQTT_BROKER_PORT), MQTT_CONNECT_TIMEOUT)
+    writer.close()
+    await writer.wait_closed()
+    mqtt_client.connect_async(address, MQTT_BROKER_PORT, MQTT_KEEPALIVE)
+    mqtt_client.reconnect()
+
+async def mqtt_misc_loop():
+    """
+    Service MQTT keepalive pings and retries once a second, and (re)connect
+    whenever the client has no connection. Every attempt after the first
+    waits out the exponential backoff first, so a failed connect, a refused
+    CONNACK and a dropped session are all retried at the same bounded rate.
+    """
+    global _mqtt_reconnect_delay
+    first_attempt = True
+    while True:
+        if mqtt_client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+            if not first_attempt:
+                delay = _mqtt_reconnect_delay
+                logger.warning("MQTT not connected, retrying in %s s", delay)
+                await asyncio.sleep(delay)
+                _mqtt_reconnect_delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+            first_attempt = False
+            try:
+                await connect_mqtt()
+            except Exception as e:
+                logger.warning("MQTT connection failed: %r", e)
+            # Check again right away: a failed attempt backs off before the
+            # next one, a successful one starts servicing the new socket.
+            continue
+        await asyncio.sleep(1)
+
+def find_sensor_file():
+    """
+    Return the w1_slave path of the first DS18B20 on the bus, or None.
+    A single scandir pass filters on the entry name, avoiding glob's
+    fnmatch over every device entry.
+    """
+    try:
+        with os.scandir(W1_DEVICES_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(DS18B20_PREFIX):
+                    return os.path.join(entry.path, "w1_slave")
+    except OSError as e:
+        logger.error("Cannot scan %s: %s", W1_DEVICES_DIR, e)
+    return None
 
 def read_temperature():
     """
     Read temperature from the DS18B20 sensor.
-    The sensor data is available under /sys/bus/w1/devices/28-*/w1_slave.
+    The sensor file is opened once at startup by main(); reading a sysfs
+    attribute from offset 0 makes the kernel regenerate it.
     """
     try:
-        # Find the sensor file; assume only one sensor is connected.
-        sensor_files = glob.glob("/sys/bus/w1/devices/28-*/w1_slave")
-        if not sensor_files:
-            logger.error("No DS18B20 sensor found!")
-            return None
-        sensor_file = sensor_files[0]
-        with open(sensor_file, "r") as f:
-            lines = f.readlines()
-        # Check for a successful reading
-        if lines[0].strip()[-3:] != "YES":
+        # The kernel returns the whole (~75 byte) record in a single read.
+        data = os.pread(_SENSOR_FD, 96, 0)
+        # Check for a successful reading (CRC line ends with YES)
+        if b"YES" not in data[:40]:
             logger.error("Temperature sensor not ready.")
             return None
-        # Parse temperature from second line
-        equals_pos = lines[1].find("t=")
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos + 2:]
-            temperature = float(temp_string) / 1000.0
-            return temperature
+        # Parse temperature from the trailing t=<millidegrees>
+        _, found, temp_string = data.rpartition(b"t=")
+        if found:
+            return int(temp_string) / 1000.0
     except Exception as e:
         logger.exception("Error reading temperature: %s", e)
         return None
@@ -148,54 +314,129 @@ def read_relay_state():
         logger.exception("Error reading relay state: %s", e)
         return "UNKNOWN"
 
-def send_data(temperature, relay_state):
-    """Publish sensor data via MQTT and write the data point to InfluxDB."""
-    # Publish MQTT messages
-    temp_payload = json.dumps({"temperature": temperature})
-    relay_payload = json.dumps({"relay": relay_state})
-    mqtt_client.publish(MQTT_TOPIC_TEMPERATURE, temp_payload)
-    mqtt_client.publish(MQTT_TOPIC_RELAY, relay_payload)
-    logger.info("Published MQTT messages: %s, %s", temp_payload, relay_payload)
-
-    # Write data point to InfluxDB
-    point = (
-        Point("beerpi")
-        .field("temperature", temperature if temperature is not None else 0.0)
-        .field("relay", 1 if relay_state == "ON" else 0)
+def send_data(temperature, relay_state, timestamp_ns):
+    """
+    Publish sensor data via MQTT and write the data point to InfluxDB.
+    timestamp_ns is the sample time, so both sinks carry the same timestamp
+    regardless of when the batched write is flushed.
+    """
+    # Publish one combined MQTT state message
+    state_payload = json_dumps({
+        "temperature": temperature,
+        "relay": relay_state,
+        "ts": timestamp_ns // 1_000_000_000,
+    })
+    mqtt_client.publish(MQTT_TOPIC_STATE, state_payload, qos=0)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Published MQTT message: %s", state_payload.decode("utf-8"))
+
+    # Write data point to InfluxDB. The schema is fixed, so build the line
+    # protocol directly; relay is an integer field (the "i" suffix).
+    record = "beerpi temperature={},relay={}i {}".format(
+        float(temperature) if temperature is not None else 0.0,
+        1 if relay_state == "ON" else 0,
+        timestamp_ns,
     )
     try:
-        write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=point)
-        logger.info("Wrote data to InfluxDB: %s", point.to_line_protocol())
+        write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=record,
+                        write_precision=WritePrecision.NS)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Queued data for InfluxDB: %s", record)
     except Exception as e:
         logger.exception("Error writing to InfluxDB: %s", e)
 
-def cleanup(signum, frame):
-    """Cleanup function for graceful exit."""
+def cleanup():
+    """
+    Cleanup function for graceful exit. Runs as an event loop callback (see
+    poll_loop()), never inside a signal handler, so logging and the other
+    lock-taking calls here cannot deadlock against the interrupted code.
+    """
     logger.info("Shutting down BeerPi...")
+    # Flush any points still queued in the batching write API.
+    write_api.close()
+    influx_client.close()
     GPIO.cleanup()
+    if _SENSOR_FD is not None:
+        os.close(_SENSOR_FD)
     mqtt_client.disconnect()
-    sys.exit(0)
+    # Nothing services the socket after exit, so flush the DISCONNECT now.
+    mqtt_client.loop_write()
+    # Drain queued log records to the file before exiting.
+    log_listener.stop()
+    # Everything is flushed. Exit without joining the Influx client's
+    # non-daemon retry worker, which may still be backing off against an
+    # unreachable server after close() has given up on it.
+    os._exit(0)
 
-def main():
-    # Setup GPIO mode and relay pin
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(GPIO_RELAY_PIN, GPIO.OUT)
-    # (If needed, you can initialize the relay output state here.)
+async def poll_loop():
+    """
+    Poll the sensors and publish their readings every POLL_INTERVAL seconds.
+    Blocking sensor IO runs in worker threads so the event loop stays free
+    for MQTT traffic between samples.
+    """
+    loop = asyncio.get_running_loop()
+    attach_mqtt_to_loop(loop)
+    mqtt_client.on_connect = on_mqtt_connect
+
+    # Register signal handlers for graceful shutdown.
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, cleanup)
+    # Only records the broker; mqtt_misc_loop() resolves it and connects.
+    mqtt_client.connect_async(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE)
+    # Keep a reference so the housekeeping task is not garbage collected.
+    mqtt_task = asyncio.create_task(mqtt_misc_loop())
 
     # Publish Home Assistant auto discovery messages on startup.
     publish_homeassistant_discovery()
 
-    # Register signal handlers for graceful shutdown.
-    signal.signal(signal.SIGINT, cleanup)
-    signal.signal(signal.SIGTERM, cleanup)
-
     logger.info("Starting BeerPi loop with a %s second interval.", POLL_INTERVAL)
+    # Bind the per-cycle callables and settings to locals once; none of them
+    # change while the loop runs.
+    to_thread, sleep, now = asyncio.to_thread, asyncio.sleep, loop.time
+    time_ns = time.time_ns
+    interval = POLL_INTERVAL
+    log_enabled, log_info = logger.isEnabledFor, logger.info
+
+    # Schedule samples against the loop's monotonic clock so the time spent
+    # converting and publishing does not stretch the interval.
+    next_tick = now()
     while True:
-        temperature = read_temperature()
+        temperature = await to_thread(read_temperature)
+        sampled_at = time_ns()
+        # GPIO.input is a register read, far cheaper than a thread hop.
         relay_state = read_relay_state()
-        logger.info("Temperature: %s °C, Relay: %s", temperature, relay_state)
-        send_data(temperature, relay_state)
-        time.sleep(POLL_INTERVAL)
+        if log_enabled(logging.INFO):
+            log_info("Temperature: %s °C, Relay: %s", temperature, relay_state)
+        # MQTT publishes must stay on the loop thread; the batched Influx
+        # write only enqueues, so neither blocks.
+        send_data(temperature, relay_state, sampled_at)
+
+        next_tick += interval
+        current = now()
+        if next_tick <= current:
+            # Overran one or more slots; skip to the next future slot rather
+            # than firing the missed samples back to back.
+            next_tick += interval * (1 + (current - next_tick) // interval)
+        await sleep(next_tick - current)
+
+def main():
+    global _SENSOR_FILE, _SENSOR_FD
+
+    # Setup GPIO mode and relay pin
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(GPIO_RELAY_PIN, GPIO.OUT)
+    # (If needed, you can initialize the relay output state here.)
+
+    # Locate the sensor once; the sysfs path does not change after boot.
+    _SENSOR_FILE = find_sensor_file()
+    if _SENSOR_FILE is None:
+        logger.error("No DS18B20 sensor found!")
+        log_listener.stop()
+        sys.exit(1)
+    _SENSOR_FD = os.open(_SENSOR_FILE, os.O_RDONLY)
+    logger.info("Using DS18B20 sensor at %s", _SENSOR_FILE)
+
+    asyncio.run(poll_loop())
 
 if __name__ == "__main__":
     main()